@@ -1,9 +1,12 @@
 from sched import scheduler
 
-from flask import Flask, jsonify, request, session
+from flask import Flask, jsonify, request, session, send_file
 from flask_cors import CORS
 import uuid
 import os
+import io
+import base64
+import hashlib
 from PIL import Image
 import cv2
 import time
@@ -11,6 +14,7 @@ import numpy as np
 
 from depth_map_generator import depth_map_generator
 from anaglyph_generator import anaglyph_generator
+from render_coordinator import RenderCoordinator, ServerBusyError, SupersededError
 from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
 
@@ -27,6 +31,12 @@ load_dotenv()
 host = os.getenv("FLASK_HOST", "0.0.0.0")
 port = int(os.getenv("FLASK_PORT", 8000))
 
+# Renders allowed to run at once in this process, and how many more can wait for a slot before we return 429
+RENDER_MAX_CONCURRENT = int(os.getenv("RENDER_MAX_CONCURRENT", 2))
+RENDER_MAX_QUEUED = int(os.getenv("RENDER_MAX_QUEUED", 8))
+# Seconds the client is told to wait before retrying when the render queue is full
+RENDER_RETRY_AFTER = 1
+
 # Secret key for session management
 app.secret_key = 'super secret key'
 
@@ -43,6 +53,9 @@ os.makedirs(SESSION_DATA_FOLDER, exist_ok=True)
 
 # Previously had a dictionary of session last activity time, but managing concurrency is too hard
 
+# Coalesces identical renders, drops renders superseded by a newer one for the same session, and bounds the queue
+render_coordinator = RenderCoordinator(RENDER_MAX_CONCURRENT, RENDER_MAX_QUEUED)
+
 ALLOWED_EXTENSIONS = {
     'bmp', 'dib',        # Windows bitmaps
     'jpeg', 'jpg', 'jpe', # JPEG files
@@ -73,7 +86,10 @@ def hello_world():  # put application's code here
 def assign_session_id():
     """
     Assigns a session ID to the session object if it does not already exist for the current user
+    Stateless routes don't use the session, so are skipped to avoid setting a cookie
     """
+    if request.path.startswith('/stateless/'):
+        return
     if 'session_id' not in session:
         session['session_id'] = uuid.uuid4()
 
@@ -98,6 +114,33 @@ def clear_old_session_files():
 clean_up_scheduler = BackgroundScheduler()
 clean_up_scheduler.add_job(clear_old_session_files, 'interval', hours=1) # Every hour
 clean_up_scheduler.start()
+
+def open_uploaded_image(image) -> Image.Image:
+    """
+    Opens an uploaded image, fixing the rotation of iPhone images, converting to RGB and resizing to MAX_DIMENSION
+    :param image: The uploaded file, or anything else Image.open accepts
+    :returns: The pillow image
+    """
+    pillow_image = Image.open(image)
+
+    # To fix rotation issue with iPhone images
+    exif_data = pillow_image._getexif()
+    if exif_data is not None:
+        orientation = exif_data.get(274)
+        if orientation == 3:
+            pillow_image = pillow_image.rotate(180, expand=True)
+        elif orientation == 6:
+            pillow_image = pillow_image.rotate(270, expand=True)
+        elif orientation == 8:
+            pillow_image = pillow_image.rotate(90, expand=True)
+
+    pillow_image = pillow_image.convert('RGB') # Required for jpg
+
+    if pillow_image.width > MAX_DIMENSION or pillow_image.height > MAX_DIMENSION:
+        pillow_image.thumbnail((MAX_DIMENSION, MAX_DIMENSION))
+
+    return pillow_image
+
 @app.route('/image', methods=['POST'])
 def upload_image():
     """
@@ -115,23 +158,7 @@ def upload_image():
         return jsonify({'error': 'No selected file'}), 400
     if image.filename.split('.')[-1].lower() in ALLOWED_EXTENSIONS:
         try:
-            pillow_image = Image.open(image)
-
-            # To fix rotation issue with iPhone images
-            exif_data = pillow_image._getexif()
-            if exif_data is not None:
-                orientation = exif_data.get(274)
-                if orientation == 3:
-                    pillow_image = pillow_image.rotate(180, expand=True)
-                elif orientation == 6:
-                    pillow_image = pillow_image.rotate(270, expand=True)
-                elif orientation == 8:
-                    pillow_image = pillow_image.rotate(90, expand=True)
-
-            pillow_image = pillow_image.convert('RGB') # Required for jpg
-
-            if pillow_image.width > MAX_DIMENSION or pillow_image.height > MAX_DIMENSION:
-                pillow_image.thumbnail((MAX_DIMENSION, MAX_DIMENSION))
+            pillow_image = open_uploaded_image(image)
 
             image_name = f"{session['session_id']}_image.jpg"
             image_path = os.path.join(SESSION_DATA_FOLDER, image_name)
@@ -167,13 +194,23 @@ def get_random_image():
 def get_depth_map():
     """
     API endpoint to get the depth map for the uploaded image.
+    Identical requests for the same image share one computation, and a newer request for the session drops older queued ones.
     :returns: The path to the depth map coloured for the front end to access
     """
     depth_map_coloured_name = f"{session['session_id']}_depth_map_coloured.jpg"
     depth_map_coloured_path = os.path.join(SESSION_DATA_FOLDER, depth_map_coloured_name)
 
     # Reprocess every time to ensure the latest image is used (as a change in image will still leave the old depth map)
-    process_depth_maps()
+    # The image's modification time is part of the key, so a new upload never joins a computation on the old image
+    image_path = os.path.join(SESSION_DATA_FOLDER, f"{session['session_id']}_image.jpg")
+    image_modified_time = os.stat(image_path).st_mtime_ns if os.path.exists(image_path) else None
+    params = (image_modified_time, session.get('random_image'), session.get('random_image_index'))
+    try:
+        render_coordinator.run(session['session_id'], 'depth_map', params, process_depth_maps)
+    except ServerBusyError as e:
+        return render_busy_response(e)
+    except SupersededError as e:
+        return jsonify({'error': str(e)}), 409
 
     # Using werkzeug's send_from_directory instead of flask, as flask's version for some reason uses the backend as the working directory
     # and that doesn't match with SESSION_DATA_FOLDER or even the os.path.exists check above
@@ -181,11 +218,22 @@ def get_depth_map():
     # Need to pass extra request.environ tho, as flask's version does that for us
     return send_from_directory(SESSION_DATA_FOLDER, depth_map_coloured_name, request.environ)
 
-def process_depth_maps():
+def render_busy_response(error: ServerBusyError):
+    """
+    Response for when the render queue is full, telling the client to back off and retry
+    :param error: The error raised by the render coordinator
+    :returns: A 429 response with a Retry-After header
+    """
+    response = jsonify({'error': str(error)})
+    response.headers['Retry-After'] = str(RENDER_RETRY_AFTER)
+    return response, 429
+
+def process_depth_maps(check_superseded):
     """
     Processes the image in the session_data folder to create depth maps.
     Saves the coloured depth map for display, and saves the normalised depth map, with a blur (only if uploaded and not random) to reduce incorrect edges
     as an .npy file for use in stereo image generation
+    :param check_superseded: Raises SupersededError if a newer depth map request for the session has come in
     """
     try:
         image_name = f"{session['session_id']}_image.jpg"
@@ -212,7 +260,8 @@ def process_depth_maps():
             depth_map = depth_map_generator.generate_depth_map_performant(image, depth_map_resize_dimension,
                                                                           depth_map_resize_dimension)
 
-
+        # Don't overwrite the files of a newer request for this session
+        check_superseded()
 
         depth_map_coloured = depth_map_generator.colour_depth_map(depth_map)
         depth_map_coloured_name = f"{session['session_id']}_depth_map_coloured.jpg"
@@ -227,6 +276,8 @@ def process_depth_maps():
         depth_map_name = f"{session['session_id']}_depth_map.npy"
         depth_map_path = os.path.join(SESSION_DATA_FOLDER, depth_map_name)
         np.save(depth_map_path, depth_map_blurred)
+    except SupersededError:
+        raise
     except Exception as e:
         print(f"Error processing depth maps: {e}")
 
@@ -234,47 +285,226 @@ def process_depth_maps():
 def get_anaglyph():
     """
     API endpoint to get the anaglyph for the uploaded image.
+    Identical requests share one render, and a newer render for the session cancels older ones (409), as the slider and toggles fire quickly.
     :pop_out: Whether the anaglyph should pop out of the screen (default: false)
     :max_disparity: The maximum disparity for the depth map (default: 25)
     :optimised_RR_anaglyph: Whether to generate an optimised RR anaglyph (default: false)
     :returns: The anaglyph image file
     """
-    anaglyph_name = f"{session['session_id']}_anaglyph.jpg"
-    anaglyph_path = os.path.join(SESSION_DATA_FOLDER, anaglyph_name)
-    left_image_path = os.path.join(SESSION_DATA_FOLDER, f"{session['session_id']}_left_image.jpg")
-    right_image_path = os.path.join(SESSION_DATA_FOLDER, f"{session['session_id']}_right_image.jpg")
+    try:
+        pop_out = request.args.get("pop_out", default="false").lower() == "true"
+        max_disparity_percentage = float(request.args.get("max_disparity_percentage", default=25))
+        optimised_RR_anaglyph = request.args.get("optimised_RR_anaglyph", default="false").lower() == "true"
+
+        session_id = session['session_id']
+        # The depth map's modification time is part of the key, so a render after a new depth map never joins one of the old
+        depth_map_path = os.path.join(SESSION_DATA_FOLDER, f"{session_id}_depth_map.npy")
+        depth_map_modified_time = os.stat(depth_map_path).st_mtime_ns if os.path.exists(depth_map_path) else None
+        params = (depth_map_modified_time, pop_out, max_disparity_percentage, optimised_RR_anaglyph)
+        anaglyph_bytes = render_coordinator.run(session_id, 'anaglyph', params,
+                                                lambda check_superseded: render_anaglyph(session_id, pop_out, max_disparity_percentage,
+                                                                                         optimised_RR_anaglyph, check_superseded))
+    except ServerBusyError as e:
+        return render_busy_response(e)
+    except SupersededError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        return jsonify({"Error generating anaglyph": str(e)}), 400
+
+    # Send from memory rather than the session file, as a render with other parameters may have since overwritten it
+    return send_file(io.BytesIO(anaglyph_bytes), mimetype='image/jpeg')
+
+def render_anaglyph(session_id, pop_out: bool, max_disparity_percentage: float, optimised_RR_anaglyph: bool, check_superseded) -> bytes:
+    """
+    Renders the anaglyph for the session's image and depth map, saving the stereo images and anaglyph to the session data folder.
+    :param session_id: The session to render for. Passed in as this may run on behalf of several requests
+    :param pop_out: Whether the anaglyph should pop out of the screen
+    :param max_disparity_percentage: The maximum disparity as a percentage of the image width
+    :param optimised_RR_anaglyph: Whether to generate an optimised RR anaglyph
+    :param check_superseded: Raises SupersededError if a newer anaglyph request for the session has come in
+    :returns: The anaglyph encoded as a jpg
+    """
+    anaglyph_path = os.path.join(SESSION_DATA_FOLDER, f"{session_id}_anaglyph.jpg")
+    left_image_path = os.path.join(SESSION_DATA_FOLDER, f"{session_id}_left_image.jpg")
+    right_image_path = os.path.join(SESSION_DATA_FOLDER, f"{session_id}_right_image.jpg")
+
+    depth_map_name = f"{session_id}_depth_map.npy"
+    depth_map_path = os.path.join(SESSION_DATA_FOLDER, depth_map_name)
+    depth_map = np.load(depth_map_path)
+
+    image_name = f"{session_id}_image.jpg"
+    image_path = os.path.join(SESSION_DATA_FOLDER, image_name)
+    image = cv2.imread(image_path)
+    if image is None:
+        raise FileNotFoundError(f"Image not found at path: {image_path}")
+
+    left_image, right_image, anaglyph_bytes = generate_anaglyph(image, depth_map, pop_out, max_disparity_percentage,
+                                                                optimised_RR_anaglyph, check_superseded)
+
+    # Don't overwrite the files of a newer render for this session
+    check_superseded()
+    cv2.imwrite(left_image_path, left_image)
+    cv2.imwrite(right_image_path, right_image)
+    with open(anaglyph_path, 'wb') as anaglyph_file:
+        anaglyph_file.write(anaglyph_bytes)
+
+    return anaglyph_bytes
+
+def generate_anaglyph(image: np.ndarray, depth_map: np.ndarray, pop_out: bool, max_disparity_percentage: float,
+                      optimised_RR_anaglyph: bool, check_superseded) -> tuple:
+    """
+    Generates the stereo images and anaglyph from an image and its blurred depth map, without touching the disk.
+    :param check_superseded: Raises SupersededError if the render is no longer wanted
+    :returns: The left image, right image, and the anaglyph encoded as a jpg
+    """
+    left_image, right_image = anaglyph_generator.generate_stereo_images(image, depth_map, pop_out, max_disparity_percentage)
+
+    # Stereo generation is the expensive part, so bail out here if the user has already moved on
+    check_superseded()
+
+    if optimised_RR_anaglyph:
+        anaglyph = anaglyph_generator.generate_optimised_RR_anaglyph(left_image, right_image)
+    else:
+        anaglyph = anaglyph_generator.generate_pure_anaglyph(left_image, right_image)
+
+    success, anaglyph_encoded = cv2.imencode('.jpg', anaglyph)
+    if not success:
+        raise ValueError("Failed to encode anaglyph")
+
+    return left_image, right_image, anaglyph_encoded.tobytes()
+
+# Stateless mode: the client sends the image (and the depth artifact once it has one) with every request,
+# so nothing is kept in the session or on disk and any node behind a plain load balancer can serve any request
 
+def read_stateless_image() -> tuple:
+    """
+    Reads the image from the 'file' field of a stateless request
+    :returns: The raw uploaded bytes (for the render key), and the image as a BGR numpy array, as cv2.imread would give
+    :raises ValueError: If the file is missing, of the wrong type or can't be opened
+    """
+    if 'file' not in request.files or request.files['file'].filename == '':
+        raise ValueError("No file part")
+    image = request.files['file']
+    if image.filename.split('.')[-1].lower() not in ALLOWED_EXTENSIONS:
+        raise ValueError("Invalid file type")
+
+    image_bytes = image.read()
     try:
-        depth_map_name = f"{session['session_id']}_depth_map.npy"
-        depth_map_path = os.path.join(SESSION_DATA_FOLDER, depth_map_name)
-        depth_map = np.load(depth_map_path)
+        pillow_image = open_uploaded_image(io.BytesIO(image_bytes))
+    except Exception as e:
+        raise ValueError(str(e) + " Note: transparent background not allowed")
+    return image_bytes, cv2.cvtColor(np.array(pillow_image), cv2.COLOR_RGB2BGR)
 
-        image_name = f"{session['session_id']}_image.jpg"
-        image_path = os.path.join(SESSION_DATA_FOLDER, image_name)
-        image = cv2.imread(image_path)
-        if image is None:
-            raise FileNotFoundError(f"Image not found at path: {image_path}")
+def stateless_render_id(*parts) -> str:
+    """
+    Identifies a stateless render by its inputs, so identical requests from any client coalesce,
+    and different ones never supersede each other (unlike session renders)
+    :param parts: The raw uploaded bytes and parameters of the request
+    :returns: A hex digest of the parts
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else repr(part).encode())
+        digest.update(b'\0')
+    return f"stateless_{digest.hexdigest()}"
 
-        pop_out = request.args.get("pop_out", default="false").lower() == "true"
-        max_disparity_percentage = float(request.args.get("max_disparity_percentage", default=25))
-        left_image, right_image = anaglyph_generator.generate_stereo_images(image, depth_map, pop_out, max_disparity_percentage)
+def generate_stateless_depth_maps(image_bytes: bytes, image: np.ndarray) -> tuple:
+    """
+    Generates the depth maps for an uploaded image, as process_depth_maps does for a session.
+    Keyed on the image alone, so /stateless/depth-map and renders without a depth artifact share one inference
+    :param image_bytes: The raw uploaded bytes, to identify the image
+    :param image: The decoded image
+    :returns: The normalised depth map, and the blurred depth map used for stereo image generation
+    """
+    def generate(check_superseded):
+        depth_map = depth_map_generator.generate_depth_map_performant(image, depth_map_resize_dimension,
+                                                                      depth_map_resize_dimension)
+        return depth_map, depth_map_generator.blur_depth_map(depth_map, KERNEL_WIDTH)
 
-        cv2.imwrite(left_image_path, left_image)
-        cv2.imwrite(right_image_path, right_image)
+    return render_coordinator.run(stateless_render_id(image_bytes), 'depth_map', (), generate)
 
-        optimised_RR_anaglyph = request.args.get("optimised_RR_anaglyph", default="false").lower() == "true"
-        if optimised_RR_anaglyph:
-            anaglyph = anaglyph_generator.generate_optimised_RR_anaglyph(left_image, right_image)
+def read_depth_artifact(depth_artifact_bytes: bytes, image: np.ndarray) -> np.ndarray:
+    """
+    Decodes a depth artifact sent back by the client
+    :param depth_artifact_bytes: The greyscale png returned by /stateless/depth-map
+    :param image: The image it was generated for, to check the dimensions match
+    :returns: The normalised blurred depth map
+    :raises ValueError: If it can't be decoded or doesn't match the image
+    """
+    depth_artifact = cv2.imdecode(np.frombuffer(depth_artifact_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if depth_artifact is None:
+        raise ValueError("Invalid depth map")
+    if depth_artifact.shape != image.shape[:2]:
+        raise ValueError("Depth map does not match the image dimensions")
+    return depth_artifact / 255.0
+
+@app.route('/stateless/depth-map', methods=['POST'])
+def get_stateless_depth_map():
+    """
+    API endpoint to get the depth map for an image, without storing anything on the server.
+    :file: The image
+    :returns: JSON with the base64 encoded coloured depth map (jpg) for display, and the depth artifact (png)
+    to send back to /stateless/anaglyph so the depth map isn't regenerated on every render
+    """
+    try:
+        image_bytes, image = read_stateless_image()
+        depth_map, depth_map_blurred = generate_stateless_depth_maps(image_bytes, image)
+
+        # The blurred depth map is already quantised to 8 bits, so a greyscale png is lossless and far smaller than the .npy
+        success, depth_artifact = cv2.imencode('.png', np.round(depth_map_blurred * 255).astype(np.uint8))
+        if not success:
+            raise ValueError("Failed to encode depth map")
+        success, depth_map_coloured = cv2.imencode('.jpg', depth_map_generator.colour_depth_map(depth_map))
+        if not success:
+            raise ValueError("Failed to encode coloured depth map")
+    except ServerBusyError as e:
+        return render_busy_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'depth_map_coloured': base64.b64encode(depth_map_coloured.tobytes()).decode('ascii'),
+        'depth_map': base64.b64encode(depth_artifact.tobytes()).decode('ascii'),
+    }), 200
+
+@app.route('/stateless/anaglyph', methods=['POST'])
+def get_stateless_anaglyph():
+    """
+    API endpoint to get the anaglyph for an image in a single request, without storing anything on the server.
+    Parameters are taken from the query string or the form.
+    :file: The image
+    :depth_map: The depth artifact from /stateless/depth-map for this image (optional, generated if not given)
+    :pop_out: Whether the anaglyph should pop out of the screen (default: false)
+    :max_disparity: The maximum disparity for the depth map (default: 25)
+    :optimised_RR_anaglyph: Whether to generate an optimised RR anaglyph (default: false)
+    :returns: The anaglyph image file
+    """
+    try:
+        image_bytes, image = read_stateless_image()
+        depth_artifact_bytes = request.files['depth_map'].read() if 'depth_map' in request.files else None
+
+        pop_out = request.values.get("pop_out", default="false").lower() == "true"
+        max_disparity_percentage = float(request.values.get("max_disparity_percentage", default=25))
+        optimised_RR_anaglyph = request.values.get("optimised_RR_anaglyph", default="false").lower() == "true"
+
+        # Depth map first, outside the anaglyph render, so it doesn't hold a render slot while waiting for another
+        if depth_artifact_bytes is None:
+            _, depth_map = generate_stateless_depth_maps(image_bytes, image)
         else:
-            anaglyph = anaglyph_generator.generate_pure_anaglyph(left_image, right_image)
+            depth_map = read_depth_artifact(depth_artifact_bytes, image)
 
-        cv2.imwrite(anaglyph_path, anaglyph)
+        def render(check_superseded):
+            return generate_anaglyph(image, depth_map, pop_out, max_disparity_percentage, optimised_RR_anaglyph, check_superseded)[2]
 
+        params = (pop_out, max_disparity_percentage, optimised_RR_anaglyph)
+        anaglyph_bytes = render_coordinator.run(stateless_render_id(image_bytes, depth_artifact_bytes, params), 'anaglyph',
+                                                params, render)
+    except ServerBusyError as e:
+        return render_busy_response(e)
     except Exception as e:
         return jsonify({"Error generating anaglyph": str(e)}), 400
 
-    # Werkzeug's version of send_from_directory
-    return send_from_directory(SESSION_DATA_FOLDER, anaglyph_name, request.environ)
+    return send_file(io.BytesIO(anaglyph_bytes), mimetype='image/jpeg')
 
 if __name__ == '__main__':
     # Don't use 5000, as that's something apple uses. Use 8000 instead
@@ -1,6 +1,7 @@
 import time
 
 start_import_time = time.time()
+import os
 import cv2
 import torch
 import numpy as np
@@ -10,6 +11,20 @@ end_import_time = time.time()
 elapsed_import_time = end_import_time - start_import_time
 print(f"Elapsed time for imports: {elapsed_import_time:.4f} seconds")
 
+class StubDepthModel:
+    """
+    Stand in for DepthAnythingV2 for load testing without the checkpoint.
+    Sleeps for roughly the real inference time, then returns a vertical gradient (top furthest, bottom closest)
+    """
+
+    def __init__(self, inference_seconds: float):
+        self.inference_seconds = inference_seconds
+
+    def infer_image(self, image: np.ndarray) -> np.ndarray:
+        time.sleep(self.inference_seconds)
+        height, width = image.shape[:2]
+        return np.tile(np.linspace(0, 1, height, dtype=np.float32)[:, None], (1, width))
+
 # Singleton
 class DepthMapGenerator:
     _instance = None
@@ -29,6 +44,12 @@ class DepthMapGenerator:
         Load the pre-trained model.
         :param encoder: The version of the model to load. Options: 'vits', 'vitb', 'vitl', 'vitg'.
         """
+        # Set STUB_DEPTH_MODEL=true to skip loading the real model, e.g. when load testing the serving stack
+        if os.getenv("STUB_DEPTH_MODEL", "false").lower() == "true":
+            self.model = StubDepthModel(float(os.getenv("STUB_DEPTH_MODEL_SECONDS", 0.5)))
+            print("Loaded stub model")
+            return
+
         print("Loading model")
         DEVICE = 'cuda' if torch.cuda.is_available() else 'mps' if torch.backends.mps.is_available() else 'cpu'
 
@@ -127,9 +148,6 @@ class DepthMapGenerator:
         # Apply horizontal blur
         blurred_depth_map_scaled = cv2.blur(depth_map_scaled, (kernel_width, 1))
 
-        # To check its working
-        cv2.imwrite('Blurred_Depth_Map.jpg', blurred_depth_map_scaled)
-
         # Normalize back to the range [0, 1]
         blurred_depth_map = blurred_depth_map_scaled / 255.0
 
@@ -0,0 +1,331 @@
+"""
+Load testing harness for the API in app.py.
+
+Virtual users replay realistic editing sessions against the real routes, carrying the session cookie like the browser does:
+upload an image (or get a random one), get the depth map, then tweak the slider and toggles a few times, sometimes in quick
+bursts where the frontend fires a new /anaglyph before the previous one has returned.
+
+Either point it at a running server:
+    python load_test.py --url http://127.0.0.1:8000 --users 8 --duration 60
+or have it start gunicorn locally for each workers x threads configuration, optionally with the stub depth model:
+    python load_test.py --configs 1x1,1x4,2x4 --stub-model --users 8 --duration 60
+Add --stateless to replay the same sessions against /stateless/depth-map and /stateless/anaglyph instead,
+sending the image and depth artifact with every render rather than relying on the session cookie.
+
+Reports throughput and p50/p95/p99 latency of successful responses per route for each configuration.
+"""
+import argparse
+import base64
+import io
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+from PIL import Image
+
+BACKEND_FOLDER = os.path.dirname(os.path.abspath(__file__))
+IMAGES_FOLDER = os.path.join(BACKEND_FOLDER, 'resources/images')
+
+ROUTES = ['/image', '/random_image', '/depth-map', '/anaglyph', '/stateless/depth-map', '/stateless/anaglyph']
+
+# Same as the frontend's slider
+MIN_DISPARITY_PERCENTAGE = 0
+MAX_DISPARITY_PERCENTAGE = 6
+
+# Gap between the requests of a burst, like a user flicking the slider or clicking the toggles
+BURST_INTERVAL = 0.05
+
+
+class RouteStats:
+    """
+    Thread safe record of the latency and status of every request, per route
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {route: [] for route in ROUTES}  # Successful responses only
+        self.statuses = {route: {} for route in ROUTES}  # status -> count, with 'error' for connection errors
+
+    def request(self, http: requests.Session, method: str, base_url: str, route: str, timeout: float, **kwargs):
+        """
+        Make a request and record it.
+        :returns: The response if it was successful, otherwise None
+        """
+        start_time = time.perf_counter()
+        try:
+            response = http.request(method, base_url + route, timeout=timeout, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 'error'
+        elapsed_time = time.perf_counter() - start_time
+
+        with self._lock:
+            self.statuses[route][status] = self.statuses[route].get(status, 0) + 1
+            if status == 200:
+                self.latencies[route].append(elapsed_time)
+        return response if status == 200 else None
+
+    def report(self, title: str, elapsed_time: float):
+        """
+        Print throughput and latency percentiles per route
+        """
+        print(f"\n{title} ({elapsed_time:.1f}s)")
+        print(f"{'route':<22}{'ok':>7}{'409':>6}{'429':>6}{'other':>7}{'ok/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for route in ROUTES:
+            statuses = self.statuses[route]
+            if not statuses:
+                continue
+            ok = statuses.get(200, 0)
+            other = sum(count for status, count in statuses.items() if status not in (200, 409, 429))
+            if ok:
+                p50, p95, p99 = np.percentile(self.latencies[route], [50, 95, 99]) * 1000
+            else:
+                p50 = p95 = p99 = float('nan')
+            print(f"{route:<22}{ok:>7}{statuses.get(409, 0):>6}{statuses.get(429, 0):>6}{other:>7}"
+                  f"{ok / elapsed_time:>8.2f}{p50:>9.0f}{p95:>9.0f}{p99:>9.0f}")
+
+
+def load_upload_images(max_dimension: int) -> list:
+    """
+    Load the test images and encode them as the frontend would upload them, resized to max_dimension and as jpg
+    :returns: List of (file name, jpg bytes)
+    """
+    upload_images = []
+    for file_name in sorted(os.listdir(IMAGES_FOLDER)):
+        try:
+            pillow_image = Image.open(os.path.join(IMAGES_FOLDER, file_name)).convert('RGB')
+        except Exception:
+            continue
+        pillow_image.thumbnail((max_dimension, max_dimension))
+        image_bytes = io.BytesIO()
+        pillow_image.save(image_bytes, format='JPEG')
+        upload_images.append((f"{os.path.splitext(file_name)[0]}.jpg", image_bytes.getvalue()))
+    return upload_images
+
+
+def anaglyph_params(settings: dict) -> dict:
+    """
+    Query parameters for /anaglyph, formatted as the frontend sends them
+    """
+    return {
+        'pop_out': str(settings['pop_out']).lower(),
+        'max_disparity_percentage': settings['max_disparity_percentage'],
+        'optimised_RR_anaglyph': str(settings['optimised_RR_anaglyph']).lower(),
+    }
+
+
+def change_setting(settings: dict, rng: random.Random) -> dict:
+    """
+    Change one setting like a user would, mostly the slider, sometimes a toggle
+    :returns: New settings
+    """
+    settings = dict(settings)
+    choice = rng.random()
+    if choice < 0.7:
+        settings['max_disparity_percentage'] = round(rng.uniform(MIN_DISPARITY_PERCENTAGE, MAX_DISPARITY_PERCENTAGE), 1)
+    elif choice < 0.85:
+        settings['pop_out'] = not settings['pop_out']
+    else:
+        settings['optimised_RR_anaglyph'] = not settings['optimised_RR_anaglyph']
+    return settings
+
+
+def run_editing_session(base_url: str, upload_images: list, rng: random.Random, stats: RouteStats, args):
+    """
+    Replay one editing session: image, depth map, initial anaglyph, then a number of slider and toggle renders
+    """
+    http = requests.Session()
+
+    if not upload_images or rng.random() < args.random_image_ratio:
+        ok = stats.request(http, 'GET', base_url, '/random_image', args.timeout)
+    else:
+        file_name, image_bytes = rng.choice(upload_images)
+        ok = stats.request(http, 'POST', base_url, '/image', args.timeout,
+                           files={'file': (file_name, image_bytes, 'image/jpeg')})
+    if not ok or not stats.request(http, 'GET', base_url, '/depth-map', args.timeout):
+        return
+
+    def send_render(settings: dict, render_http: requests.Session):
+        stats.request(render_http, 'GET', base_url, '/anaglyph', args.timeout, params=anaglyph_params(settings))
+
+    def new_render_http() -> requests.Session:
+        burst_http = requests.Session()
+        burst_http.cookies.update(http.cookies)
+        return burst_http
+
+    replay_renders(send_render, http, new_render_http, rng, args)
+
+
+def run_stateless_editing_session(base_url: str, upload_images: list, rng: random.Random, stats: RouteStats, args):
+    """
+    Replay one editing session against the stateless routes: the image goes up with every request,
+    and the depth artifact from /stateless/depth-map is sent back with every render
+    """
+    http = requests.Session()
+
+    if not upload_images or rng.random() < args.random_image_ratio:
+        # Stateless mode has no random image route, so get one and send it back like an upload
+        response = stats.request(http, 'GET', base_url, '/random_image', args.timeout)
+        if response is None:
+            return
+        file_name, image_bytes = 'random_image.jpg', response.content
+    else:
+        file_name, image_bytes = rng.choice(upload_images)
+
+    response = stats.request(http, 'POST', base_url, '/stateless/depth-map', args.timeout,
+                             files={'file': (file_name, image_bytes, 'image/jpeg')})
+    if response is None:
+        return
+    depth_artifact = base64.b64decode(response.json()['depth_map'])
+
+    def send_render(settings: dict, render_http: requests.Session):
+        stats.request(render_http, 'POST', base_url, '/stateless/anaglyph', args.timeout, params=anaglyph_params(settings),
+                      files={'file': (file_name, image_bytes, 'image/jpeg'), 'depth_map': ('depth_map.png', depth_artifact, 'image/png')})
+
+    replay_renders(send_render, http, requests.Session, rng, args)
+
+
+def replay_renders(send_render, http: requests.Session, new_render_http, rng: random.Random, args):
+    """
+    Replay the editor part of a session: the initial anaglyph, then args.renders slider and toggle changes
+    :param send_render: Function taking the settings and the requests session to render with
+    :param http: The session's requests session, for renders one at a time
+    :param new_render_http: Makes a requests session for each render of a burst, as they run in parallel
+    """
+    # Frontend defaults
+    settings = {'pop_out': False, 'max_disparity_percentage': 2.0, 'optimised_RR_anaglyph': False}
+    send_render(settings, http)
+
+    for _ in range(args.renders):
+        time.sleep(rng.uniform(0.5, 1.5) * args.think_time)
+        if rng.random() < args.burst_probability:
+            # The frontend doesn't wait for the previous render before firing the next, so these overlap
+            burst_threads = []
+            for _ in range(rng.randint(2, 4)):
+                settings = change_setting(settings, rng)
+                burst_thread = threading.Thread(target=send_render, args=(settings, new_render_http()))
+                burst_thread.start()
+                burst_threads.append(burst_thread)
+                time.sleep(BURST_INTERVAL)
+            for burst_thread in burst_threads:
+                burst_thread.join()
+        else:
+            settings = change_setting(settings, rng)
+            send_render(settings, http)
+
+def run_virtual_user(base_url: str, upload_images: list, seed: int, stop_time: float, stats: RouteStats, args):
+    """
+    Keep replaying editing sessions until stop_time
+    """
+    rng = random.Random(seed)
+    editing_session = run_stateless_editing_session if args.stateless else run_editing_session
+    while time.time() < stop_time:
+        editing_session(base_url, upload_images, rng, stats, args)
+
+
+def run_load_test(base_url: str, upload_images: list, args) -> tuple:
+    """
+    Run args.users virtual users against base_url for args.duration seconds
+    :returns: The stats, and how long it actually took (sessions in progress at the deadline are allowed to finish)
+    """
+    stats = RouteStats()
+    start_time = time.time()
+    stop_time = start_time + args.duration
+    users = [threading.Thread(target=run_virtual_user, args=(base_url, upload_images, args.seed + user, stop_time, stats, args))
+             for user in range(args.users)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    return stats, time.time() - start_time
+
+
+def start_server(workers: int, threads: int, port: int, stub_model: bool, startup_timeout: float) -> subprocess.Popen:
+    """
+    Start gunicorn serving app.py, and wait until it responds (loading the model can take a while)
+    """
+    env = dict(os.environ)
+    if stub_model:
+        env['STUB_DEPTH_MODEL'] = 'true'
+    server = subprocess.Popen(['gunicorn', '-w', str(workers), '--threads', str(threads), 'app:app', '-b', f"127.0.0.1:{port}"],
+                              cwd=BACKEND_FOLDER, env=env)
+
+    deadline = time.time() + startup_timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {server.returncode}")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                return server
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+
+    stop_server(server)
+    raise RuntimeError(f"gunicorn did not respond within {startup_timeout} seconds")
+
+
+def stop_server(server: subprocess.Popen):
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def parse_configs(configs: str) -> list:
+    """
+    Parse a comma separated list of <workers>x<threads>, e.g. 1x1,1x4,2x4
+    """
+    parsed_configs = []
+    for config in configs.split(','):
+        workers, threads = config.lower().split('x')
+        parsed_configs.append((int(workers), int(threads)))
+    return parsed_configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay realistic editing sessions against the Anaglyph AI API and report per route latency")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help="Base URL of an already running server")
+    target.add_argument('--configs', help="Comma separated gunicorn <workers>x<threads> configurations to start locally, e.g. 1x1,1x4,2x4")
+    parser.add_argument('--port', type=int, default=8001, help="Port for locally started servers")
+    parser.add_argument('--stub-model', action='store_true', help="Start local servers with the stub depth model instead of the real one")
+    parser.add_argument('--startup-timeout', type=float, default=300, help="Seconds to wait for a local server to start")
+    parser.add_argument('--stateless', action='store_true', help="Replay sessions against the stateless routes")
+    parser.add_argument('--users', type=int, default=8, help="Number of concurrent virtual users")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds to keep starting new editing sessions for")
+    parser.add_argument('--renders', type=int, default=6, help="Slider and toggle changes per editing session")
+    parser.add_argument('--think-time', type=float, default=1.0, help="Mean seconds between changes")
+    parser.add_argument('--burst-probability', type=float, default=0.3, help="Chance a change is a quick burst of overlapping renders")
+    parser.add_argument('--random-image-ratio', type=float, default=0.25, help="Chance a session uses /random_image instead of uploading")
+    parser.add_argument('--max-dimension', type=int, default=1500, help="Client side resize of uploads, as the frontend does")
+    parser.add_argument('--timeout', type=float, default=120, help="Per request timeout in seconds")
+    parser.add_argument('--seed', type=int, default=0, help="Seed so runs replay the same sessions")
+    args = parser.parse_args()
+
+    upload_images = load_upload_images(args.max_dimension)
+
+    if args.url:
+        stats, elapsed_time = run_load_test(args.url.rstrip('/'), upload_images, args)
+        stats.report(f"{args.url}, {args.users} users", elapsed_time)
+        return
+
+    for workers, threads in parse_configs(args.configs):
+        server = start_server(workers, threads, args.port, args.stub_model, args.startup_timeout)
+        try:
+            stats, elapsed_time = run_load_test(f"http://127.0.0.1:{args.port}", upload_images, args)
+        finally:
+            stop_server(server)
+        stats.report(f"gunicorn -w {workers} --threads {threads}, {args.users} users", elapsed_time)
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import threading
+
+# How often a request waiting for a render slot checks whether it has been superseded
+QUEUE_POLL_INTERVAL = 0.05
+
+
+class ServerBusyError(Exception):
+    """
+    Raised when the render queue is full, so the request should be rejected (429) instead of piling up
+    """
+
+
+class SupersededError(Exception):
+    """
+    Raised when a newer render for the same session has come in, so this one is no longer wanted
+    """
+
+
+class _Job:
+    """
+    A single in flight computation, shared by every identical request that joins it
+    """
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.cancelled = False  # Set under the coordinator's lock once superseded, so nothing joins it after
+        self.queued = True  # Still waiting for a render slot, so a newer request can drop it straight away
+        self.holds_place = True  # Counts towards the coordinator's pending renders
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def finish(self, result, error):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class RenderCoordinator:
+    """
+    Coordinates expensive renders (depth maps and anaglyphs) across request threads in this process.
+    - Identical in flight requests (same session, kind and parameters) share one computation.
+    - A newer request for a session and kind supersedes older ones, which are dropped while queued (freeing
+      their queue place for it), or cancelled at the next checkpoint if already running.
+    - At most max_concurrent renders run at once, with at most max_queued waiting behind them.
+      Anything beyond that is rejected with ServerBusyError, but only once no older queued request
+      from the same session and kind can be dropped to make room.
+    """
+
+    def __init__(self, max_concurrent: int, max_queued: int):
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_concurrent)
+        self._max_pending = max_concurrent + max_queued
+        self._pending = 0
+        self._in_flight = {}  # (session_id, kind, params) -> _Job
+        self._latest_generation = {}  # (session_id, kind) -> generation of the newest request
+        self._stream_jobs = {}  # (session_id, kind) -> number of jobs in flight, so old entries can be dropped
+
+    def run(self, session_id, kind: str, params: tuple, compute):
+        """
+        Run compute for this session, coalescing with an identical in flight request if there is one.
+        :param session_id: The session the render is for.
+        :param kind: The kind of render, e.g. 'depth_map' or 'anaglyph'. Newer renders only supersede older ones of the same kind.
+        :param params: Hashable parameters that, together with the session and kind, identify identical requests.
+        :param compute: Function taking a check_superseded callable, which raises SupersededError if a newer render has come in.
+        It should call it between expensive stages, and before writing anything to disk.
+        :return: The result of compute, possibly computed by another request.
+        :raises ServerBusyError: If the render queue is full.
+        :raises SupersededError: If a newer render for this session and kind came in before this one finished.
+        """
+        stream = (session_id, kind)
+        key = (session_id, kind, params)
+
+        with self._lock:
+            generation = self._latest_generation.get(stream, 0) + 1
+            job = self._in_flight.get(key)
+            if job is not None and not job.cancelled:
+                # Identical request already running, so join it. It is now the newest request for the stream
+                self._latest_generation[stream] = generation
+                job.generation = generation
+                is_owner = False
+            else:
+                # This supersedes the queued requests for the stream, so drop them now rather than at their next
+                # poll, letting this take their place instead of being rejected while they hold it
+                self._drop_queued_jobs(stream)
+                if self._pending >= self._max_pending:
+                    raise ServerBusyError("Too many renders in progress, try again shortly")
+                self._latest_generation[stream] = generation
+                self._pending += 1
+                self._stream_jobs[stream] = self._stream_jobs.get(stream, 0) + 1
+                job = _Job(generation)
+                self._in_flight[key] = job
+                is_owner = True
+
+        if not is_owner:
+            return job.wait()
+
+        def check_superseded():
+            # Checked and cancelled under the lock, so a request can't join the job between the two
+            with self._lock:
+                if job.cancelled or self._latest_generation.get(stream) != job.generation:
+                    if not job.cancelled:
+                        job.cancelled = True
+                        # Stop identical requests from joining, they start a new job instead
+                        if self._in_flight.get(key) is job:
+                            del self._in_flight[key]
+                    raise SupersededError("A newer render for this session superseded this one")
+
+        result, error = None, None
+        try:
+            self._acquire_slot(check_superseded)
+            try:
+                with self._lock:
+                    job.queued = False
+                check_superseded()
+                result = compute(check_superseded)
+            finally:
+                self._slots.release()
+        except Exception as e:
+            error = e
+        finally:
+            # Remove the job before finishing it, so any request arriving after this computes afresh
+            with self._lock:
+                if self._in_flight.get(key) is job:
+                    del self._in_flight[key]
+                if job.holds_place:
+                    self._pending -= 1
+                self._stream_jobs[stream] -= 1
+                if self._stream_jobs[stream] == 0:
+                    del self._stream_jobs[stream]
+                    del self._latest_generation[stream]
+            job.finish(result, error)
+
+        return job.wait()
+
+    def _drop_queued_jobs(self, stream):
+        """
+        Cancel the stream's jobs still waiting for a render slot, and free their queue places.
+        Their requests raise SupersededError when they next poll. Must be called with the lock held
+        :param stream: The (session_id, kind) being superseded.
+        """
+        for key, job in list(self._in_flight.items()):
+            if key[:2] == stream and job.queued:
+                job.cancelled = True
+                job.holds_place = False
+                self._pending -= 1
+                del self._in_flight[key]
+
+    def _acquire_slot(self, check_superseded):
+        """
+        Wait for a render slot, giving up as soon as the request is superseded so it stops holding a queue place
+        :param check_superseded: Raises SupersededError if a newer render has come in.
+        """
+        while not self._slots.acquire(timeout=QUEUE_POLL_INTERVAL):
+            check_superseded()
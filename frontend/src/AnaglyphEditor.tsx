@@ -1,10 +1,13 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import "./styles/AnaglyphEditor.css";
+import fetchRetryingWhenBusy from "./fetchRetryingWhenBusy";
 
 function AnaglyphEditor({ isDepthMapReady, isChangeAllowed, setIsChangeAllowed}: { isDepthMapReady: boolean , isChangeAllowed: boolean, setIsChangeAllowed: (value: boolean) => void}) {
     const apiUrl = import.meta.env.VITE_FLASK_BACKEND_API_URL;
     const [anaglyphUrl, setAnaglyphUrl] = useState<string | null>(null);
     const [anaglyphIsLoading, setAnaglyphIsLoading] = useState<boolean>(false);
+    // Counts anaglyph requests, so a response can tell if a newer request from this editor is on its way
+    const latestAnaglyphRequest = useRef<number>(0);
 
     // State for form inputs
     const [popOut, setPopOut] = useState<boolean>(false);
@@ -29,9 +32,10 @@ function AnaglyphEditor({ isDepthMapReady, isChangeAllowed, setIsChangeAllowed}:
      }, [anaglyphIsLoading]);
 
     const fetchAnaglyph = async () => {
+        const anaglyphRequest = ++latestAnaglyphRequest.current;
         try {
             setAnaglyphIsLoading(true); // Start loading spinner
-            const response = await fetch(
+            const response = await fetchRetryingWhenBusy(
                 `${apiUrl}/anaglyph?pop_out=${popOut}&max_disparity_percentage=${maxDisparityPercentage}&optimised_RR_anaglyph=${optimiseRRAnaglyph}`,
                 {
                     method: "GET",
@@ -45,13 +49,23 @@ function AnaglyphEditor({ isDepthMapReady, isChangeAllowed, setIsChangeAllowed}:
                 const anaglyphUrl = URL.createObjectURL(anaglyphBlob);
                 setAnaglyphUrl(anaglyphUrl);
                 console.log("Anaglyph fetched successfully", anaglyphUrl);
+            } else if (response.status === 409 && anaglyphRequest !== latestAnaglyphRequest.current) {
+                // Superseded by a newer render from this editor (e.g. slider moved again), which will stop the loading spinner
+                console.log("Anaglyph superseded by a newer render");
+            } else if (response.status === 409) {
+                // Superseded by a render from elsewhere with the same session (e.g. another tab), so nothing here will stop the spinner
+                console.log("Anaglyph superseded by a render from another tab");
+                setAnaglyphIsLoading(false); // Stop loading spinner
+                setIsChangeAllowed(true);
             } else {
                 console.error("Failed to fetch Anaglyph", response.json());
+                setAnaglyphIsLoading(false); // Stop loading spinner
                 setIsChangeAllowed(true); // If failed to get anaglyph, allow user to upload new image
 
             }
         } catch (error) {
             console.error("Failed to fetch Anaglyph", error);
+            setAnaglyphIsLoading(false); // Stop loading spinner
             setIsChangeAllowed(true); // If failed to get anaglyph, allow user to upload new image
         }
     };
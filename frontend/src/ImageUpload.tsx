@@ -1,5 +1,6 @@
 import {useState, useRef} from "react";
 import "./styles/ImageUpload.css";
+import fetchRetryingWhenBusy from "./fetchRetryingWhenBusy";
 import ResizeObserver from 'react-resize-observer'; // To trigger re calculation of image pair layout on window resize
 
 // @ts-ignore
@@ -8,6 +9,8 @@ function ImageUpload({ setIsDepthMapReadyStateLifter, isChangeAllowed, setIsChan
     const [imageUrl, setImageUrl] = useState<string | null>(null);
     const [depthMapUrl, setDepthMapUrl] = useState<string | null>(null);
     const [depthMapIsLoading, setDepthMapIsLoading] = useState<boolean>(false);
+    // Counts depth map requests, so a response can tell if a newer request from this page is on its way
+    const latestDepthMapRequest = useRef<number>(0);
     const apiUrl = import.meta.env.VITE_FLASK_BACKEND_API_URL;
     const maxDimension = import.meta.env.VITE_MAX_DIMENSION; // Client side resizing to reduce internet bandwidth
     const [imageAspectRatio, setImageAspectRatio] = useState<number>(0); // width / height
@@ -146,8 +149,9 @@ function ImageUpload({ setIsDepthMapReadyStateLifter, isChangeAllowed, setIsChan
     }
 
     const fetchDepthMap = async () => {
+        const depthMapRequest = ++latestDepthMapRequest.current;
         try {
-            const response = await fetch(`${apiUrl}/depth-map`, {
+            const response = await fetchRetryingWhenBusy(`${apiUrl}/depth-map`, {
                 method: "GET",
                 credentials: "include",
             });
@@ -163,11 +167,23 @@ function ImageUpload({ setIsDepthMapReadyStateLifter, isChangeAllowed, setIsChan
                 console.log("Depth map fetched successfully", depthMapUrl);
                 setIsDepthMapReadyStateLifter(true); // Set depth map ready to true to start rendering anaglyph editor
 
+            } else if (response.status === 409 && depthMapRequest !== latestDepthMapRequest.current) {
+                // Superseded by a newer depth map request from this page (e.g. another image), which will handle the result
+                console.log("Depth map superseded by a newer request");
+            } else if (response.status === 409) {
+                // Superseded by a request from elsewhere with the same session (e.g. another tab), so nothing here will stop the spinner
+                console.log("Depth map superseded by a request from another tab");
+                setDepthMapIsLoading(false); // Stop loading spinner
+                setIsChangeAllowed(true);
             } else {
                 console.error("Failed to fetch depth map", response.statusText);
+                setDepthMapIsLoading(false); // Stop loading spinner
+                setIsChangeAllowed(true); // If failed to get depth map, allow user to upload new image
             }
         } catch (error) {
             console.error("Failed to fetch depth map", error);
+            setDepthMapIsLoading(false); // Stop loading spinner
+            setIsChangeAllowed(true); // If failed to get depth map, allow user to upload new image
         }
     }
 
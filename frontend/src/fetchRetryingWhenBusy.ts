@@ -0,0 +1,19 @@
+// Give up after this many attempts, and return the last 429 for the caller to handle as a failure
+const MAX_ATTEMPTS = 10;
+// Used if the server doesn't send a Retry-After header
+const DEFAULT_RETRY_AFTER_SECONDS = 1;
+
+// Fetch, but when the server is busy (429) wait for Retry-After and try again, as the server now rejects renders
+// instead of queueing them indefinitely
+async function fetchRetryingWhenBusy(url: string, init: RequestInit): Promise<Response> {
+    let response = await fetch(url, init);
+    for (let attempt = 1; attempt < MAX_ATTEMPTS && response.status === 429; attempt++) {
+        const retryAfterSeconds = parseFloat(response.headers.get("Retry-After") ?? "") || DEFAULT_RETRY_AFTER_SECONDS;
+        console.log(`Server busy, retrying in ${retryAfterSeconds}s`);
+        await new Promise((resolve) => setTimeout(resolve, retryAfterSeconds * 1000));
+        response = await fetch(url, init);
+    }
+    return response;
+}
+
+export default fetchRetryingWhenBusy;